@@ -0,0 +1,135 @@
+import os
+import argparse
+import logging
+import sys
+import functools
+import multiprocessing
+import pysam
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------ Count the spliced reads -------------------------->
+
+# Only uniquely mapping reads (NH:i:1) are considered, paired-endedness
+# is ignored. A read is spliced if its CIGAR contains a skipped region
+# (N, BAM_CREF_SKIP).
+
+BAM_CREF_SKIP = 3
+
+
+def count_spliced(reads):
+    '''
+    Return the numbers of spliced and unspliced uniquely mapped reads.
+    '''
+
+    spliced = 0
+    unspliced = 0
+
+    for read in reads:
+
+        if read.cigartuples is None:
+            continue
+
+        if not read.has_tag("NH") or read.get_tag("NH") != 1:
+            continue
+
+        if any(op == BAM_CREF_SKIP for op, _ in read.cigartuples):
+            spliced += 1
+        else:
+            unspliced += 1
+
+    return spliced, unspliced
+
+
+def count_contig(bam_file, contig):
+    '''
+    Count the reads on a single contig using the BAM index.
+    '''
+
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        return count_spliced(bam.fetch(contig))
+
+
+def main():
+
+    # <------------------------------ Arguments ------------------------------>
+
+    L.info("parsing arguments")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bam", default=None, type=str,
+                        help="The BAM file")
+    parser.add_argument("--threads", default=1, type=int,
+                        help="Number of threads. If the BAM file is indexed "
+                             "the contigs are counted in parallel by this "
+                             "number of processes, otherwise it sets the "
+                             "number of htslib decompression threads")
+    parser.add_argument("--outfile", default=None, type=str,
+                        help="name of the outfile")
+
+    args = parser.parse_args()
+
+    L.info("Running with arguments:")
+    print(args)
+
+    # <--------------------------- Sanity checks(s) -------------------------->
+
+    if args.bam is None:
+        raise ValueError("Input BAM file path not given")
+
+    if not os.path.exists(args.bam):
+        raise ValueError("BAM file: " + args.bam + " does not exist")
+
+    if args.outfile is None:
+        raise ValueError("Outfile not specified")
+
+    # <------------------------ Count the spliced reads ---------------------->
+
+    L.info("counting spliced and unspliced reads")
+
+    with pysam.AlignmentFile(args.bam, "rb", threads=args.threads) as bam:
+
+        indexed = bam.has_index()
+
+        # largest contigs first to balance the work between processes
+        contigs = [c for c, l in sorted(zip(bam.references, bam.lengths),
+                                        key=lambda x: x[1], reverse=True)]
+
+        if not indexed or args.threads == 1:
+            spliced, unspliced = count_spliced(bam.fetch(until_eof=True))
+
+    if indexed and args.threads > 1:
+
+        L.info("counting %d contigs in %d processes" % (len(contigs),
+                                                        args.threads))
+
+        with multiprocessing.Pool(args.threads) as pool:
+            counts = pool.map(functools.partial(count_contig, args.bam),
+                              contigs, chunksize=1)
+
+        spliced = sum(x[0] for x in counts)
+        unspliced = sum(x[1] for x in counts)
+
+    L.info("spliced: %d, unspliced: %d" % (spliced, unspliced))
+
+    if spliced + unspliced > 0:
+        fraction_spliced = "%.6g" % (spliced / (spliced + unspliced))
+    else:
+        fraction_spliced = "NA"
+
+    with open(args.outfile, "w") as out_file:
+        out_file.write("fraction_spliced\n")
+        out_file.write(fraction_spliced + "\n")
+
+    L.info("complete")
+
+
+if __name__ == "__main__":
+    main()
@@ -57,6 +57,11 @@ Default configuration files can be generated by executing:
 Input files
 -----------
 
+Sanger CRAM files in a "data.dir" folder. The CRAM files of each cell
+(identified by the SM tag of the read group) are concatenated with
+``samtools cat`` and streamed through a single ``samtools fastq``
+process, so no per-CRAM fastq files are written.
+
 Requirements
 ------------
 
@@ -69,7 +74,12 @@ software to be in the path:
 
 Requirements:
 
-* samtools >= 1.1
+* samtools >= 1.9
+* bgzip (htslib)
+* seqkit
+
+For best performance samtools and bgzip should be built against
+libdeflate (htslib ``./configure --with-libdeflate``).
 
 Pipeline output
 ===============
@@ -89,7 +99,11 @@ from ruffus import *
 import sys
 import os
 import glob
+import re
 import sqlite3
+import subprocess
+import collections
+import multiprocessing
 
 from CGATCore import Experiment as E
 from CGATCore import Pipeline as P
@@ -108,6 +122,13 @@ PARAMS = P.get_parameters(
 
 # ----------------------- < pipeline configuration > ------------------------ #
 
+# Resolve CRAM references from a local cache only: by default htslib
+# fetches unknown references from the EBI reference server (by md5).
+if PARAMS["cram2fastq_ref_cache"]:
+    ref_cache = os.path.join(PARAMS["cram2fastq_ref_cache"], "%2s/%2s/%s")
+    os.environ["REF_CACHE"] = ref_cache
+    os.environ["REF_PATH"] = ref_cache
+
 if len(sys.argv) > 1:
     if(sys.argv[1] == "config") and __name__ == "__main__":
         sys.exit(P.main(sys.argv))
@@ -116,75 +137,113 @@ if len(sys.argv) > 1:
 # ------------------------< specific pipeline tasks >------------------------ #
 
 @follows(mkdir("validate.cram.dir"))
-@transform(glob.glob("data.dir/*.cram"),
-           regex(r".*/(.*).cram"),
-           [r"validate.cram.dir/\1.validate", r"validate.cram.dir/\1.quality"])
-def validateCramFiles(infile, outfiles):
+@files(None, "validate.cram.dir/samtools.version")
+def checkSamtools(infile, outfile):
+    '''Record the samtools version and warn if htslib
+       was not built with libdeflate.'''
+
+    statement = '''samtools --version > %(outfile)s'''
+
+    P.run(statement)
+
+    with open(outfile, "r") as version_handle:
+        if "libdeflate=yes" not in version_handle.read():
+            E.warn("samtools is not built with libdeflate: "
+                   "(de)compression will be slower")
+
+
+@follows(mkdir("validate.cram.dir"))
+@merge(glob.glob("data.dir/*.cram"),
+       "validate.cram.dir/all.validate")
+def validateCramFiles(infiles, outfile):
     '''Validate CRAM files by exit status of
-       cramtools qstat. Save the quality scores of cram files.
+       samtools quickcheck.
+
+       All the files are checked by a single job, the exit status
+       of each check is recorded next to the file name.
     '''
 
-    outfile, outfile_quality = outfiles
+    cram_files = " ".join(infiles)
 
-    statement = '''temp_quality=`mktemp -p %(cluster_tmpdir)s`;
-                   cramtools qstat -I %(infile)s > $temp_quality;
-                   echo $? > %(outfile)s;
-                   cat $temp_quality
-                   | awk '{OFS="\\t"} {print $1,$2}'
-                   > %(outfile_quality)s;
-                   rm $temp_quality;
+    statement = '''printf "%%s\\n" %(cram_files)s
+                   | xargs -n 1 -P %(validate_threads)s
+                     sh -c 'if samtools quickcheck "$0";
+                            then printf "%%s\\t0\\n" "$0";
+                            else printf "%%s\\t1\\n" "$0"; fi'
+                   > %(outfile)s
                 '''
 
-    P.run(statement)
+    P.run(statement, job_threads=PARAMS["validate_threads"])
 
 
-@follows(validateCramFiles)
-@merge(validateCramFiles,
-       "validate.cram.dir/summary.txt")
-def inspectValidations(infiles, outfile):
+@transform(validateCramFiles,
+           regex(r"(.*)/all.validate"),
+           r"\1/summary.txt")
+def inspectValidations(infile, outfile):
     '''Check that all crams pass validation or
        raise an Error.'''
 
-    validation_files = [fn
-                        for filenames in infiles
-                        for fn in filenames
-                        if fn.endswith(".validate")]
+    with open(infile, "r") as validation_handle:
+        results = [line.rstrip("\n").split("\t")
+                   for line in validation_handle]
+
+    with open(outfile, "w") as outfile_handle:
+        outfile_handle.writelines("%s\t%s\n" % tuple(result)
+                                  for result in results)
 
-    outfile_handle = open(outfile, "w")
+    if any(int(exit_status) != 0 for _, exit_status in results):
+        raise ValueError("One or more cram files failed validation")
 
-    exit_states = []
-    for validation_file in validation_files:
 
-        with open(validation_file, "r") as vf_handle:
-            exit_status = vf_handle.read().strip("\n")
+SM_REGEX = re.compile(r"^@RG(?:\t[^\t\n]*)*?\tSM:([^\t\n]+)", re.MULTILINE)
 
-        exit_states.append(int(exit_status))
-        outfile_handle.write("\t".join([validation_file, exit_status])+"\n")
 
-    outfile_handle.close()
+def _get_sm(cram_file):
+    '''Return the sample (SM) of the first read group of a
+       cram file together with the file name.
 
-    if sum(exit_states) != 0:
-        raise ValueError("One or more cram files failed validation")
+       Only the header text is read: the file is not checked for
+       truncation and the header is not parsed into a dictionary.
 
+       The sample is cached in a "<cram>.sm" file keyed on the
+       modification time and size of the cram so that the header
+       is only read again if the file changes.'''
 
-@follows(validateCramFiles)
-@merge(validateCramFiles,
-       "validate.cram.dir/cram_quality.load")
-def loadCramQuality(infiles, outfile):
-    ''' Load the quality scores for the different cells
-        into the database (summarized table).
-    '''
+    reference_fasta = PARAMS["cram2fastq_reference"] or None
+
+    st = os.stat(cram_file)
+    key = "%d:%d" % (st.st_mtime_ns, st.st_size)
+    cache_file = cram_file + ".sm"
+
+    if os.path.exists(cache_file):
+        with open(cache_file, "r") as cache_handle:
+            cached = cache_handle.read().split("\n")
+        if len(cached) > 1 and cached[0] == key and cached[1] != "":
+            return(cached[1], cram_file)
+
+    cram = pysam.AlignmentFile(cram_file, mode="rc",
+                               check_sq=False, require_index=False,
+                               ignore_truncation=True,
+                               reference_filename=reference_fasta,
+                               threads=PARAMS["cram_read_threads"])
+    header_text = str(cram.header)
+    cram.close()
+
+    match = SM_REGEX.search(header_text)
+    if match is None:
+        raise ValueError("No read group sample (SM) found in the header"
+                         " of " + cram_file)
 
-    quality_files = [fn
-                     for filenames in infiles
-                     for fn in filenames
-                     if fn.endswith(".quality")]
+    cell = match.group(1)
 
-    P.concatenate_and_load(quality_files, outfile,
-                           regex_filename="validate.cram.dir/(.*).quality",
-                           cat="track",
-                           has_titles=False,
-                           header="cramID,number_reads,cram_quality_score")
+    try:
+        with open(cache_file, "w") as cache_handle:
+            cache_handle.write("%s\n%s\n" % (key, cell))
+    except OSError:
+        # the data folder may not be writable, the cache is optional
+        pass
+
+    return(cell, cram_file)
 
 
 @follows(inspectValidations,
@@ -194,28 +253,20 @@ def loadCramQuality(infiles, outfile):
 def extractSampleInformation(infiles, outfile):
     '''Make a table of cells and corresponding cram files'''
 
+    # the headers are independent so they are read in parallel
+    with multiprocessing.Pool(PARAMS["header_threads"]) as pool:
+        pairs = pool.map(_get_sm, infiles)
+
     # build a dictionary of cell to cram file mappings
-    cells = {}
-    for cram_file in infiles:
-        cram = pysam.AlignmentFile(cram_file, "rc")
-        print(cram.header)
-        cell = cram.header["RG"][0]["SM"]
-        if cell not in cells.keys():
-            cells[cell] = [cram_file]
-        else:
-            cells[cell].append(cram_file)
-        cram.close()
+    cells = collections.defaultdict(list)
+    for cell, cram_file in pairs:
+        cells[cell].append(cram_file)
 
     # write out a per-cell list of cram files
-    outdir = os.path.dirname(outfile)
-
-    outfile_handle = open(outfile, "w")
-    outfile_handle.write("#cell\tcram_files\n")
-
-    for cell in cells.keys():
-        outfile_handle.write("\t".join([cell, ",".join(cells[cell])])+"\n")
-
-    outfile_handle.close()
+    with open(outfile, "w") as outfile_handle:
+        outfile_handle.write("#cell\tcram_files\n")
+        outfile_handle.writelines("%s\t%s\n" % (cell, ",".join(crams))
+                                  for cell, crams in cells.items())
 
 
 @split(extractSampleInformation,
@@ -226,21 +277,24 @@ def cellCramLists(infile, outfiles):
 
     out_dir = os.path.dirname(infile)
 
+    # parse the cell list before writing the per-cell files
+    cells = {}
     with open(infile, "r") as cell_list:
         for record in cell_list:
             if record.startswith("#"):
                 continue
-            cell, cram_list = record.strip("\n").split("\t")
-            crams = cram_list.split(",")
+            cell, _, cram_list = record.rstrip("\n").partition("\t")
+            cells[cell] = cram_list.split(",")
 
-            cell_outfile_name = os.path.join(out_dir, cell+".cell")
-            with open(cell_outfile_name, "w") as cell_file_handle:
-                for cram in crams:
-                    cell_file_handle.write(cram+"\n")
+    for cell, crams in cells.items():
+        cell_outfile_name = os.path.join(out_dir, cell+".cell")
+        with open(cell_outfile_name, "w") as cell_file_handle:
+            cell_file_handle.write("\n".join(crams) + "\n")
 
 
 @follows(mkdir("fastq.dir"),
          mkdir("fastq.temp.dir"),
+         checkSamtools,
          extractSampleInformation)
 @transform(cellCramLists,
            regex(r".*/(.*).cell"),
@@ -252,8 +306,6 @@ def cram2fastq(infile, outfiles):
        and pair reconciliation.
        Intermediate files are not kept by default.'''
 
-    # TODO: make quality trimming optional.
-
     ###################################
     # set variables and open a log file
     ###################################
@@ -266,48 +318,42 @@ def cram2fastq(infile, outfiles):
                             cell_name + ".fastq.extraction.log")
 
     log = open(log_file, "w")
-    log.write("Fastq extraction log file for %(infile)s\n\n")
+    log.write("Fastq extraction log file for %s\n\n" % infile)
 
-    def _merge_dicts(a, b):
-        x = a.copy()
-        x.update(b)
-        return(x)
+    # the parameters are copied once and updated with the task
+    # variables whenever a statement is rendered for the log
+    log_vars = PARAMS.copy()
 
     temp_files = []
 
-    # ##############################################
-    # Extract per-end Fastq(s) from the cram file(s)
-    # ##############################################
-
-    raw_fastq_names = []
-    with open(infile, "rb") as cram_files:
-
-        for line in cram_files:
-
-            cram = line.strip()
-            cram_basename = os.path.basename(cram)[:-len(".cram")]
-            raw_fastq_name = os.path.join(temp_dir, cram_basename)
-            raw_fastq_names.append(raw_fastq_name)
-
-            job_memory = PARAMS["preprocess_memory"]
-            statement = '''cramtools fastq
-                                       --enumerate
-                                       --reverse
-                                       -F %(raw_fastq_name)s
-                                       -I %(cram)s
-                                       --gzip
-                         '''
-            log.write("Extracting fastqs from %(cram)s:" % locals() + "\n")
-            log.write(statement % locals() + "\n")
-
-            P.run(statement)
-
-            log.write("done.\n\n")
+    # ####################################################
+    # Extract, merge and quality trim the per-end Fastq(s)
+    # ####################################################
+
+    # When trimming, the reads are streamed from samtools fastq to
+    # the quality trimmer through named pipes so that untrimmed
+    # fastqs are never written to disk. The two ends are trimmed
+    # and compressed by concurrent background jobs. The md5
+    # checksums of the compressed fastqs are computed as they
+    # are written.
+
+    with open(infile, "r") as cram_files:
+        crams = [line.rstrip("\n") for line in cram_files if line != "\n"]
+
+    if len(crams) > 1:
+        # samtools cat joins the cram containers without decoding
+        # them and keeps the read order of the individual files.
+        cram_input = "samtools cat " + " ".join(crams) + " |"
+        cram = "-"
+    else:
+        cram_input = ""
+        cram = crams[0]
 
-    # ####################################
-    # Perform quality trimming
-    # Merging is also taken care of here.
-    # ####################################
+    # htslib otherwise resolves the reference from the CRAM header
+    if PARAMS["cram2fastq_reference"]:
+        reference_option = "--reference " + PARAMS["cram2fastq_reference"]
+    else:
+        reference_option = ""
 
     quality = PARAMS["preprocess_quality_threshold"]
     minlen = PARAMS["preprocess_min_length"]
@@ -315,37 +361,109 @@ def cram2fastq(infile, outfiles):
 
     trimmed_fastq_prefix = os.path.join(temp_dir, cell_name)
 
-    trimmed_fastq_files = []
+    trimmed_fastq_files = [trimmed_fastq_prefix + end + ".trimmed.fastq.gz"
+                           for end in ["_1", "_2"]]
 
-    # fastq(s) for each end are quality trimmed separately
-    for end in ["_1", "_2"]:
+    trimmed_1, trimmed_2 = trimmed_fastq_files
 
-        raw_fastqs = [x + end + ".fastq.gz" for x in raw_fastq_names]
-        temp_files += raw_fastqs
+    job_memory = PARAMS["preprocess_memory"]
 
-        fastq_list = " ".join(raw_fastqs)
+    # If samtools fails before it opens the named pipes the background
+    # readers stay blocked in open(). They are released by briefly
+    # opening each pipe read-write (which does not block) until both
+    # of the reader pipelines have exited.
+    release_readers = '''while kill -0 $trim_1 2>/dev/null
+                               || kill -0 $trim_2 2>/dev/null; do
+                             for fifo in $fifo_dir/*; do : <> $fifo; done;
+                             sleep 1;
+                         done;
+                         rm -r $fifo_dir;'''
 
-        trimmed_fastq_name = trimmed_fastq_prefix + end + ".trimmed.fastq.gz"
-        trimmed_fastq_files.append(trimmed_fastq_name)
+    # The task is run as a single shell statement that is assembled
+    # from the segments below so that only one job is submitted.
+    statements = []
 
-        log.write(">> Quality trimming %(fastq_list)s: " % locals() + "\n")
-        if trim:
-            statement = '''zcat %(fastq_list)s
-                       | fastq_quality_trimmer
+    if trim:
+        statements.append('''fifo_dir=`mktemp -d -p %(temp_dir)s`;
+                       mkfifo $fifo_dir/1.fastq $fifo_dir/2.fastq;
+                       fastq_quality_trimmer
                            -Q33
                            -t %(quality)s
                            -l %(minlen)s
-                       | gzip -c
-                       > %(trimmed_fastq_name)s
-                       '''
-        else:
-            statement = '''zcat %(fastq_list)s
-                       | gzip -c
-                       > %(trimmed_fastq_name)s
-                       '''
-        log.write(statement % _merge_dicts(PARAMS, locals()) + "\n")
-        P.run(statement)
-        log.write("done. \n\n")
+                           < $fifo_dir/1.fastq
+                       | bgzip -@ %(bgzip_threads)s -l 6 -c
+                       | tee %(trimmed_1)s
+                       | md5sum
+                       | sed "s|-$|%(trimmed_1)s|"
+                       > %(trimmed_1)s.md5 &
+                       trim_1=$!;
+                       fastq_quality_trimmer
+                           -Q33
+                           -t %(quality)s
+                           -l %(minlen)s
+                           < $fifo_dir/2.fastq
+                       | bgzip -@ %(bgzip_threads)s -l 6 -c
+                       | tee %(trimmed_2)s
+                       | md5sum
+                       | sed "s|-$|%(trimmed_2)s|"
+                       > %(trimmed_2)s.md5 &
+                       trim_2=$!;
+                       %(cram_input)s
+                       samtools fastq
+                           -@ %(cram2fastq_threads)s
+                           %(reference_option)s
+                           -1 $fifo_dir/1.fastq
+                           -2 $fifo_dir/2.fastq
+                           -0 /dev/null
+                           -s /dev/null
+                           %(cram)s
+                       || { %(release_readers)s exit 1; };
+                       checkpoint;
+                       wait $trim_1;
+                       checkpoint;
+                       wait $trim_2;
+                       checkpoint;
+                       rm -r $fifo_dir
+                    ''')
+
+        # samtools and the two compression jobs run concurrently
+        job_threads = (PARAMS["cram2fastq_threads"]
+                       + 2 * PARAMS["bgzip_threads"])
+
+    else:
+        # without trimming samtools writes the (BGZF) compressed
+        # fastqs itself so the reads are only compressed once.
+        statements.append('''fifo_dir=`mktemp -d -p %(temp_dir)s`;
+                       mkfifo $fifo_dir/1.fastq.gz $fifo_dir/2.fastq.gz;
+                       tee %(trimmed_1)s < $fifo_dir/1.fastq.gz
+                       | md5sum
+                       | sed "s|-$|%(trimmed_1)s|"
+                       > %(trimmed_1)s.md5 &
+                       trim_1=$!;
+                       tee %(trimmed_2)s < $fifo_dir/2.fastq.gz
+                       | md5sum
+                       | sed "s|-$|%(trimmed_2)s|"
+                       > %(trimmed_2)s.md5 &
+                       trim_2=$!;
+                       %(cram_input)s
+                       samtools fastq
+                           -@ %(cram2fastq_threads)s
+                           %(reference_option)s
+                           -1 $fifo_dir/1.fastq.gz
+                           -2 $fifo_dir/2.fastq.gz
+                           -0 /dev/null
+                           -s /dev/null
+                           %(cram)s
+                       || { %(release_readers)s exit 1; };
+                       checkpoint;
+                       wait $trim_1;
+                       checkpoint;
+                       wait $trim_2;
+                       checkpoint;
+                       rm -r $fifo_dir
+                    ''')
+
+        job_threads = PARAMS["cram2fastq_threads"]
 
     # ##################
     # Reconcile the ends
@@ -359,20 +477,53 @@ def cram2fastq(infile, outfiles):
 
         reconciled_fastq_prefix = outfiles[0][:-len(".1.gz")]
 
-        log.write(">> Reconciling pairs, %(end1)s & %(end2)s: "
-                  % locals() + "\n")
-        statement = '''python %(scriptsdir)s/fastqs2fastqs.py
-                       %(end1)s %(end2)s
-                       --method reconcile
-                       --chop
-                       --unpaired
-                       -o "%(reconciled_fastq_prefix)s.%%s.gz";
-                    '''
-        log.write(statement % _merge_dicts(PARAMS, locals()) + "\n")
-        P.run(statement)
-        log.write("done\n\n")
-
-    else:
+        # With -O seqkit pair keeps the input file names for the paired
+        # reads (x_1.trimmed.fastq.gz) and adds ".unpaired" for the
+        # unpaired reads (x_1.trimmed.unpaired.fastq.gz).
+        # The /1 and /2 read name suffixes are ignored for pairing.
+        statements.append('''pair_dir=`mktemp -d -p %(temp_dir)s`;
+                       seqkit pair
+                           --id-regexp '^(\\S+)/[12]'
+                           -1 %(end1)s
+                           -2 %(end2)s
+                           --save-unpaired
+                           -j %(seqkit_threads)s
+                           -O $pair_dir;
+                       checkpoint;
+                       mv $pair_dir/%(cell_name)s_1.trimmed.fastq.gz
+                          %(reconciled_fastq_prefix)s.1.gz;
+                       mv $pair_dir/%(cell_name)s_2.trimmed.fastq.gz
+                          %(reconciled_fastq_prefix)s.2.gz;
+                       for end in 1 2; do
+                           unpaired=$pair_dir/%(cell_name)s_${end}.trimmed.unpaired.fastq.gz;
+                           if [ -e $unpaired ]; then
+                               mv $unpaired
+                                  %(reconciled_fastq_prefix)s.${end}.unpaired.gz;
+                           fi;
+                       done;
+                       rm -r $pair_dir
+                    ''')
+
+        job_threads = max(job_threads, PARAMS["seqkit_threads"])
+
+    statement = ";\n checkpoint;\n".join(statements)
+
+    # Cluster jobs do not inherit the environment of the pipeline
+    # process, so the local reference cache is exported in the job.
+    if PARAMS["cram2fastq_ref_cache"]:
+        ref_cache = os.environ["REF_CACHE"]
+        statement = ('''export REF_CACHE=%(ref_cache)s;
+                       export REF_PATH=%(ref_cache)s;
+                    ''' + statement)
+
+    log.write(">> Extracting, trimming and reconciling fastqs from "
+              + ", ".join(crams) + ":\n")
+    log_vars.update(locals())
+    log.write(statement % log_vars + "\n")
+    P.run(statement, job_threads=job_threads)
+    log.write("done.\n\n")
+
+    if PARAMS["preprocess_reconcile"] == "False":
         trimmed_fastq_prefix = outfiles[0][:-len(".1.gz")]
         for end in trimmed_fastq_files:
             if "1.trimmed" in end:
@@ -391,32 +542,30 @@ def cram2fastq(infile, outfiles):
 
         temp_file_list = " ".join(temp_files)
 
-        # record files sizes and md5 checksums of the temporary files
-        log.write(">> Recording sizes and checksums of temporary files:\n")
-        statement = '''ls -l %(temp_file_list)s
-                       > %(temp_dir)s/%(cell_name)s.ls;
-                       checkpoint;
-                       md5sum %(temp_file_list)s
-                       > %(temp_dir)s/%(cell_name)s.md5;
-                    '''
-        log.write(statement % locals() + "\n")
-        P.run(statement)
+        # record the sizes of the temporary files (the md5
+        # checksums were recorded when the files were written)
+        log.write(">> Recording sizes of temporary files:\n")
+        with open(os.path.join(temp_dir, cell_name + ".sizes"),
+                  "w") as sizes_handle:
+            sizes_handle.writelines("%s\t%d\n" % (temp_file,
+                                                  os.path.getsize(temp_file))
+                                    for temp_file in temp_files)
         log.write("done\n\n")
 
-        # unlink (delete) the temporary files
-        log.write(">> unlinking temporary files: " + temp_file_list + "\n")
+        # remove the temporary files with a single rm call
+        log.write(">> removing temporary files: " + temp_file_list + "\n")
 
-        for temp_file in temp_files:
-            os.unlink(temp_file)
+        if temp_files:
+            subprocess.run(["rm", "-f"] + temp_files, check=True)
 
-        log.write("tempororay files unlinked\n")
+        log.write("temporary files removed\n")
 
     log.close()
 
 
 # ---------------------< generic pipeline tasks >---------------------------- #
 
-@follows(cram2fastq, loadCramQuality)
+@follows(cram2fastq)
 def full():
     pass
 
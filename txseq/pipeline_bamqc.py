@@ -34,6 +34,8 @@ Requirements
 The following software is required:
 
 #. Picard
+#. pysam
+#. samtools (htslib)
 
 Output files
 ------------
@@ -64,13 +66,13 @@ import numpy as np
 
 from cgatcore import experiment as E
 from cgatcore import pipeline as P
-from cgatcore import database as DB
 import cgatcore.iotools as IOTools
 
 
 # import local pipeline utility functions
 import txseq.tasks as T
 import txseq.tasks.samples as samples
+from txseq.tasks._bias import compute_bias
 
 # ----------------------- < pipeline configuration > ------------------------ #
 
@@ -89,10 +91,17 @@ PAIRED = False
 if len(sys.argv) > 1:
     if(sys.argv[1] == "make"):
         
-        S = samples.samples(sample_tsv = PARAMS["samples"],
-                            library_tsv = None)
+        S = samples.load_samples(sample_tsv = PARAMS["samples"],
+                                 library_tsv = None)
         
         if S.npaired > 0: PAIRED = True
+
+        # The bam file of each sample and the set of paired-end samples
+        BAMS = {sample_id: os.path.join(PARAMS["bam_path"], sample_id + ".bam")
+                for sample_id in S.samples.keys()}
+
+        PAIRED_SAMPLES = set(x for x in S.samples.keys()
+                             if S.samples[x].paired == True)
         
         # Set the database locations
         DATABASE = PARAMS["sqlite"]["file"]
@@ -139,113 +148,347 @@ def flatGeneset(infile, sentinel):
     IOTools.touch_file(sentinel)
 
 
-# ------------------- Picard: CollectRnaSeqMetrics -------------------------- #
+# ------------------------------ Database ----------------------------------- #
+
+@follows(mkdir("bam.qc.dir"))
+@files(None,
+       "bam.qc.dir/configure.db.sentinel")
+def configureDb(infile, sentinel):
+    '''
+    Put the project database in write-ahead logging mode before the
+    QC tables are loaded.
+    '''
 
+    mode = T.configure_database(PARAMS["sqlite_file"])
 
-def collect_rna_seq_metrics_jobs():
+    if mode.lower() != "wal":
+        E.warn("sqlite journal mode could not be set to WAL: %s" % mode)
+
+    IOTools.touch_file(sentinel)
+
+
+# ------------------------ Reference sequence ------------------------------- #
+
+PICARD_CLASS_ARCHIVE = "annotations.dir/picard.jsa"
+
+
+def picard_java_options():
+    '''
+    Return a JAVA_TOOL_OPTIONS setting that starts the Picard JVM from
+    the shared class archive, if class data sharing is enabled.
+    '''
+
+    if PARAMS["picard_class_archive"]:
+        return 'JAVA_TOOL_OPTIONS="-XX:SharedArchiveFile=%s -Xshare:auto"' % (
+            os.path.abspath(PICARD_CLASS_ARCHIVE))
+    else:
+        return ""
 
-    for sample_id in S.samples.keys():
-    
-        yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
-                os.path.join("bam.qc.dir/rnaseq.metrics.dir/",
-                            sample_id + ".rnaseq.metrics.sentinel")])
 
-@follows(flatGeneset)
-@files(collect_rna_seq_metrics_jobs)
-def collectRnaSeqMetrics(infile, sentinel):
+@follows(mkdir("annotations.dir"))
+@files(None,
+       "annotations.dir/genome.sentinel")
+def prepareReference(infile, sentinel):
     '''
-    Run Picard CollectRnaSeqMetrics on the bam files.
+    Prepare an uncompressed, indexed copy of the genome sequence
+    with a sequence dictionary for the Picard modules.
     '''
 
     t = T.setup(infile, sentinel, PARAMS,
             memory=PARAMS["picard_memory"],
-            cpu=PARAMS["picard_threads"])
+            cpu=1)
+
+    genome_path = os.path.join(PARAMS["txseq_annotations"],
+                               "api.dir/txseq.genome.fa.gz")
+
+    if not os.path.exists(genome_path):
+        raise ValueError("Reference sequence not found")
+
+    fasta = sentinel.replace(".sentinel", ".fa")
+    fasta_dict = sentinel.replace(".sentinel", ".dict")
+
+    # Dump the classes loaded by this Picard run to the shared archive
+    # used by the subsequent Picard jobs.
+    if PARAMS["picard_class_archive"]:
+        picard_java = 'JAVA_TOOL_OPTIONS="-XX:ArchiveClassesAtExit=%s"' % (
+            os.path.abspath(PICARD_CLASS_ARCHIVE))
+    else:
+        picard_java = ""
+
+    statement = '''bgzip -d -c %(genome_path)s
+                   > %(fasta)s;
+                   samtools faidx %(fasta)s;
+                   %(picard_java)s %(picard_cmd)s CreateSequenceDictionary
+                   -R %(fasta)s
+                   -O %(fasta_dict)s
+                   &> %(log_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    P.run(statement, **t.resources)
+    IOTools.touch_file(sentinel)
+
+
+# --------------------------- Per-sample jobs ------------------------------- #
+
+def per_sample_jobs():
+    '''
+    Yield the bam file and a dictionary of the per-sample QC outputs
+    for each sample. The job generators for the individual tasks are
+    derived from this so that the samples are visited in the same order
+    by every task.
+    '''
+
+    for sample_id, bam_file in BAMS.items():
+
+        multiple_metrics = [
+            os.path.join("bam.qc.dir/rnaseq.metrics.dir/",
+                         sample_id + ".rnaseq.metrics.sentinel"),
+            os.path.join("bam.qc.dir/alignment.summary.metrics.dir/",
+                         sample_id + ".alignment.summary.metrics.sentinel")]
+
+        if sample_id in PAIRED_SAMPLES:
+
+            multiple_metrics += [
+                os.path.join("bam.qc.dir/insert.size.metrics.dir/",
+                             sample_id + ".insert.size.metrics.summary.sentinel"),
+                os.path.join("bam.qc.dir/insert.size.metrics.dir/",
+                             sample_id + ".insert.size.metrics.histogram.sentinel")]
+
+            library_complexity = os.path.join(
+                "bam.qc.dir/estimate.library.complexity.dir/",
+                sample_id + ".library.complexity.sentinel")
+
+        else:
+            library_complexity = None
+
+        outputs = {"multiple_metrics": multiple_metrics,
+                   "library_complexity": library_complexity,
+                   "fraction_spliced": os.path.join(
+                       "bam.qc.dir/fraction.spliced.dir/",
+                       sample_id + ".fraction.spliced.sentinel")}
+
+        yield(bam_file, outputs)
+
+
+# ------------------ Picard: CollectMultipleMetrics ------------------------- #
+
+
+def collect_multiple_metrics_jobs():
+
+    for bam_file, outputs in per_sample_jobs():
+
+        yield([bam_file, outputs["multiple_metrics"]])
+
+@jobs_limit(PARAMS["picard_parallel_jobs"], "picard")
+@follows(flatGeneset,
+         prepareReference,
+         mkdir("bam.qc.dir/rnaseq.metrics.dir"),
+         mkdir("bam.qc.dir/alignment.summary.metrics.dir"),
+         mkdir("bam.qc.dir/insert.size.metrics.dir"))
+@files(collect_multiple_metrics_jobs)
+def collectMultipleMetrics(infile, sentinels):
+    '''
+    Run Picard CollectMultipleMetrics on the bam files to collect the
+    rnaseq, alignment summary and (for paired-end data) insert size
+    metrics in a single pass over each bam file.
+    '''
+
+    t = T.setup(infile, sentinels[0], PARAMS,
+            memory=PARAMS["picard_memory"],
+            cpu=1)
 
     bam_file = infile
     geneset_flat = "annotations.dir/geneset.flat.gz"
-    
+
     sample_id = os.path.basename(bam_file)[:-len(".bam")]
     sample = S.samples[sample_id]
     picard_strand = sample.picard_strand
 
-    if PARAMS["picard_collectrnaseqmetrics_options"]:
-        picard_options = PARAMS["picard_collectrnaseqmetrics_options"]
+    if PARAMS["picard_collectmultiplemetrics_options"]:
+        picard_options = PARAMS["picard_collectmultiplemetrics_options"]
     else:
         picard_options = ""
 
     validation_stringency = PARAMS["picard_validation_stringency"]
 
-    coverage_out = t.out_file[:-len(".metrics")] + ".cov.hist"
-    chart_out = t.out_file[:-len(".metrics")] + ".cov.pdf"
+    reference_sequence = "annotations.dir/genome.fa"
+
+    rnaseq_metrics, alignment_summary_metrics = [
+        x.replace(".sentinel", "") for x in sentinels[:2]]
+
+    coverage_out = rnaseq_metrics[:-len(".metrics")] + ".cov.hist"
+    chart_out = rnaseq_metrics[:-len(".metrics")] + ".cov.pdf"
+    coverage_npy = coverage_out + ".npy"
+
+    if sample.paired:
+        insert_size_program = "--PROGRAM CollectInsertSizeMetrics"
+
+        picard_summary, picard_histogram = [
+            x.replace(".sentinel", "") for x in sentinels[2:]]
+        picard_histogram_pdf = picard_histogram + ".pdf"
+
+        insert_size_statement = '''awk '/^## HISTOGRAM/ {h=1; next}
+                                        h {print > "%(picard_histogram)s"; next}
+                                        /MEDIAN_INSERT_SIZE/ {print; getline; print}'
+                                     $picard_out.insert_size_metrics
+                                   > %(picard_summary)s;
+                                   mv $picard_out.insert_size_histogram.pdf
+                                      %(picard_histogram_pdf)s;
+                                ''' % locals()
+    else:
+        insert_size_program = ""
+        insert_size_statement = ""
+
+    picard_java = picard_java_options()
 
-    mktemp_template = "ctmp.CollectRnaSeqMetrics.XXXXXXXXXX"
+    mktemp_template = "ctmp.CollectMultipleMetrics.XXXXXXXXXX"
 
     statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s CollectRnaSeqMetrics
+                   %(picard_java)s %(picard_cmd)s CollectMultipleMetrics
                    -I %(bam_file)s
-                   --REF_FLAT %(geneset_flat)s
                    -O $picard_out
-                   --CHART %(chart_out)s
-                   --STRAND_SPECIFICITY %(picard_strand)s
+                   -R %(reference_sequence)s
+                   --PROGRAM null
+                   --PROGRAM RnaSeqMetrics
+                   --PROGRAM CollectAlignmentSummaryMetrics
+                   %(insert_size_program)s
+                   --REF_FLAT %(geneset_flat)s
+                   --EXTRA_ARGUMENT "RnaSeqMetrics::--STRAND_SPECIFICITY %(picard_strand)s"
+                   --EXTRA_ARGUMENT "RnaSeqMetrics::--CHART_OUTPUT %(chart_out)s"
                    --VALIDATION_STRINGENCY %(validation_stringency)s
+                   --USE_JDK_INFLATER false
+                   --USE_JDK_DEFLATER false
                    %(picard_options)s;
-                   grep . $picard_out | grep -v "#" | head -n2
-                   > %(out_file)s;
-                   grep . $picard_out
-                   | grep -A 102 "## HISTOGRAM"
-                   | grep -v "##"
-                   > %(coverage_out)s;
-                   rm $picard_out;
+                   awk '/^## HISTOGRAM/ {h=1; next}
+                        !NF || /^#/ {next}
+                        h {print > "%(coverage_out)s"; next}
+                        n < 2 {print; n++}'
+                     $picard_out.rna_metrics
+                   > %(rnaseq_metrics)s;
+                   python -c "import sys, numpy;
+                              numpy.save(sys.argv[2],
+                                         numpy.loadtxt(sys.argv[1], skiprows=1,
+                                                       usecols=(0, 1), ndmin=2))"
+                     %(coverage_out)s %(coverage_npy)s;
+                   awk '/^## HISTOGRAM/ {exit} NF && !/^#/'
+                     $picard_out.alignment_summary_metrics
+                   > %(alignment_summary_metrics)s;
+                   %(insert_size_statement)s
+                   rm $picard_out $picard_out.*;
                 ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
+
+    for sentinel in sentinels:
+        IOTools.touch_file(sentinel)
 
 
-@merge(collectRnaSeqMetrics,
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
+@merge(collectMultipleMetrics,
        "bam.qc.dir/qc_rnaseq_metrics.load")
 def loadCollectRnaSeqMetrics(infiles, outfile):
     '''
     Load the metrics to the db.
     '''
     
-    infiles = [x.replace(".sentinel", "") for x in infiles]
+    infiles = [x[0].replace(".sentinel", "") for x in infiles]
+
+    T.bulk_load(infiles, outfile,
+                regex_filename=".*/.*/(.*).rnaseq.metrics",
+                cat="sample_id",
+                database=PARAMS["sqlite_file"])
+
+
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
+@merge(collectMultipleMetrics,
+       "bam.qc.dir/qc_alignment_summary_metrics.load")
+def loadAlignmentSummaryMetrics(infiles, outfile):
+    '''
+    Load the complexity metrics to a single table in the project database.
+    '''
+
+    infiles = [x[1].replace(".sentinel", "") for x in infiles]
+
+    T.bulk_load(
+        infiles, outfile,
+        regex_filename=".*/.*/(.*).alignment.summary.metrics",
+        cat="sample_id",
+        database=PARAMS["sqlite_file"])
+
+
+@active_if(PAIRED)
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
+@merge(collectMultipleMetrics,
+       "bam.qc.dir/qc_insert_size_metrics.load")
+def loadInsertSizeMetrics(infiles, outfile):
+    '''
+    Load the insert size metrics to a single table of the project database.
+    '''
+
+    picard_summaries = [x[2].replace(".sentinel", "") for x in infiles
+                        if len(x) > 2]
+
+    T.bulk_load(picard_summaries, outfile,
+                regex_filename=(".*/.*/(.*)"
+                                ".insert.size.metrics.summary"),
+                cat="sample_id",
+                database=PARAMS["sqlite_file"])
+
 
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).rnaseq.metrics",
-                           cat="sample_id",
-                           options='-i "sample_id"')
+@active_if(PAIRED)
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
+@merge(collectMultipleMetrics,
+       "bam.qc.dir/qc_insert_size_histogram.load")
+def loadInsertSizeHistograms(infiles, outfile):
+    '''
+    Load the histograms to a single table of the project database.
+    '''
+
+    picard_histograms = [x[3].replace(".sentinel", "") for x in infiles
+                         if len(x) > 2]
+
+    T.bulk_load(
+        picard_histograms, outfile,
+        regex_filename=(".*/.*/(.*)"
+                        ".insert.size.metrics.histogram"),
+        cat="sample_id",
+        database=PARAMS["sqlite_file"])
 
 
 # --------------------- Three prime bias analysis --------------------------- #
 
-@transform(collectRnaSeqMetrics,
+@transform(collectMultipleMetrics,
            suffix(".rnaseq.metrics.sentinel"),
            ".three.prime.bias")
-def threePrimeBias(infile, outfile):
+def threePrimeBias(infiles, outfile):
     '''
     Compute a sensible three prime bias metric
     from the picard coverage histogram.
     '''
 
-    infile = infile.replace(".sentinel", "")
+    infile = infiles[0].replace(".sentinel", "")
 
     coverage_histogram = infile[:-len(".metrics")] + ".cov.hist"
 
-    df = pd.read_csv(coverage_histogram, sep="\t")
+    # columns: normalized_position, All_Reads.normalized_coverage
+    hist = np.load(coverage_histogram + ".npy", mmap_mode="r")
 
-    x = "normalized_position"
-    cov = "All_Reads.normalized_coverage"
+    x = np.asarray(hist[:, 0])
+    cov = np.asarray(hist[:, 1])
 
-    three_prime_coverage = np.mean(df[cov][(df[x] > 70) & (df[x] < 90)])
-    transcript_body_coverage = np.mean(df[cov][(df[x] > 20) & (df[x] < 90)])
-    bias = three_prime_coverage / transcript_body_coverage
+    bias = compute_bias(x, cov)
 
     with open(outfile, "w") as out_file:
         out_file.write("three_prime_bias\n")
         out_file.write("%.2f\n" % bias)
 
 
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
 @merge(threePrimeBias,
        "bam.qc.dir/qc_three_prime_bias.load")
 def loadThreePrimeBias(infiles, outfile):
@@ -253,10 +496,10 @@ def loadThreePrimeBias(infiles, outfile):
     Load the metrics in the project database.
     '''
 
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).three.prime.bias",
-                           cat="sample_id",
-                           options='-i "sample_id"')
+    T.bulk_load(infiles, outfile,
+                regex_filename=".*/.*/(.*).three.prime.bias",
+                cat="sample_id",
+                database=PARAMS["sqlite_file"])
 
 
 # ----------------- Picard: EstimateLibraryComplexity ----------------------- #
@@ -264,14 +507,13 @@ def loadThreePrimeBias(infiles, outfile):
 
 def estimate_library_complexity_jobs():
 
-    for sample_id in S.samples.keys():
-    
-        if  S.samples[sample_id].paired == True:
-    
-            yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
-                   os.path.join("bam.qc.dir/estimate.library.complexity.dir/",
-                                sample_id + ".library.complexity.sentinel")])
+    for bam_file, outputs in per_sample_jobs():
+
+        if outputs["library_complexity"] is not None:
+
+            yield([bam_file, outputs["library_complexity"]])
 
+@jobs_limit(PARAMS["picard_parallel_jobs"], "picard")
 @active_if(PAIRED and PARAMS["run_estimateLibraryComplexity"])
 @files(estimate_library_complexity_jobs)
 def estimateLibraryComplexity(infile, sentinel):
@@ -280,7 +522,7 @@ def estimateLibraryComplexity(infile, sentinel):
     '''
     t = T.setup(infile, sentinel, PARAMS,
         memory=PARAMS["picard_memory"],
-        cpu=PARAMS["picard_threads"])
+        cpu=1)
 
     if PARAMS["picard_estimatelibrarycomplexity_options"]:
         picard_options = PARAMS["picard_estimatelibrarycomplexity_options"]
@@ -289,24 +531,37 @@ def estimateLibraryComplexity(infile, sentinel):
 
     validation_stringency = PARAMS["picard_validation_stringency"]
 
+    picard_java = picard_java_options()
+
     mktemp_template = "ctmp.EstimateLibraryComplexity.XXXXXXXXXX"
 
-    statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s EstimateLibraryComplexity
+    # The metrics are streamed from Picard through a named pipe. The
+    # reader is killed if Picard fails before opening the pipe.
+    statement = '''picard_dir=`mktemp -d -p . %(mktemp_template)s`;
+                   mkfifo $picard_dir/metrics;
+                   awk '!/^#/ && NF && n < 2 {print; n++}'
+                   < $picard_dir/metrics
+                   > %(out_file)s &
+                   awk_pid=$!;
+                   %(picard_java)s %(picard_cmd)s EstimateLibraryComplexity
                    -I %(infile)s
-                   -O $picard_out
+                   -O $picard_dir/metrics
                    --VALIDATION_STRINGENCY %(validation_stringency)s
-                   %(picard_options)s;
-                   grep . $picard_out | grep -v "#" | head -n2
-                   > %(out_file)s;
-                   rm $picard_out;
+                   --USE_JDK_INFLATER false
+                   --USE_JDK_DEFLATER false
+                   %(picard_options)s
+                   || kill $awk_pid;
+                   wait $awk_pid;
+                   rm -r $picard_dir;
                 ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
     IOTools.touch_file(sentinel)
     
 
-@active_if(PAIRED)
+@active_if(PAIRED and PARAMS["run_estimateLibraryComplexity"])
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
 @merge(estimateLibraryComplexity,
        "bam.qc.dir/qc_library_complexity.load")
 def loadEstimateLibraryComplexity(infiles, outfile):
@@ -316,176 +571,10 @@ def loadEstimateLibraryComplexity(infiles, outfile):
     
     infiles = [x.replace(".sentinel", "") for x in infiles]
 
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).library.complexity",
-                           cat="sample_id",
-                           options='-i "sample_id"')
-
-
-
-# ------------------- Picard: AlignmentSummaryMetrics ----------------------- #
-
-
-def alignment_summary_metrics_jobs():
-
-    for sample_id in S.samples.keys():
-    
-        yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
-                os.path.join("bam.qc.dir/alignment.summary.metrics.dir/",
-                            sample_id + ".alignment.summary.metrics.sentinel")])
-
-@files(alignment_summary_metrics_jobs)
-def alignmentSummaryMetrics(infile, sentinel):
-    '''
-    Run Picard AlignmentSummaryMetrics on the bam files.
-    '''
-
-    t = T.setup(infile, sentinel, PARAMS,
-            memory=PARAMS["picard_memory"],
-            cpu=PARAMS["picard_threads"])
-
-    picard_options = PARAMS["picard_alignmentsummarymetric_options"]
-    validation_stringency = PARAMS["picard_validation_stringency"]
-
-    reference_sequence = os.path.join(PARAMS["txseq_annotations"],
-                                      "api.dir/txseq.genome.fa.gz")
-    
-    if not os.path.exists(reference_sequence):
-        raise ValueError("Reference sequence not found")
-
-    mktemp_template = "ctmp.CollectAlignmentSummaryMetrics.XXXXXXXXXX"
-
-    statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s CollectAlignmentSummaryMetrics
-                   -I %(infile)s
-                   -O $picard_out
-                   --REFERENCE_SEQUENCE %(reference_sequence)s
-                   --VALIDATION_STRINGENCY %(validation_stringency)s
-                   %(picard_options)s;
-                   sed -e '1,/## HISTOGRAM/!d' $picard_out
-                   | grep . | grep -v "#"
-                   > %(out_file)s;
-                   rm $picard_out;
-                ''' % dict(PARAMS, **t.var, **locals())
-
-    P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
-
-
-@merge(alignmentSummaryMetrics,
-       "bam.qc.dir/qc_alignment_summary_metrics.load")
-def loadAlignmentSummaryMetrics(infiles, outfile):
-    '''
-    Load the complexity metrics to a single table in the project database.
-    '''
-
-    infiles = [x.replace(".sentinel", "") for x in infiles]
-
-    P.concatenate_and_load(
-        infiles, outfile,
-        regex_filename=".*/.*/(.*).alignment.summary.metrics",
-        cat="sample_id",
-        options='-i "sample_id"')
-
-
-# ------------------- Picard: InsertSizeMetrics ----------------------- #
-
-def insert_size_jobs():
-
-    for sample_id in S.samples.keys():
-    
-        if  S.samples[sample_id].paired == True:
-    
-            yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
-                   [os.path.join("bam.qc.dir/insert.size.metrics.dir/",
-                                sample_id + ".insert.size.metrics.summary.sentinel"),
-                    os.path.join("bam.qc.dir/insert.size.metrics.dir/",
-                                sample_id + ".insert.size.metrics.histogram.sentinel"),
-                   ]])
-
-@active_if(PAIRED)
-@files(insert_size_jobs)
-def insertSizeMetricsAndHistograms(infile, sentinels):
-    '''
-    Run Picard InsertSizeMetrics on the BAM files to
-    collect summary metrics and histograms.'''
-
-    t = T.setup(infile, sentinels[0], PARAMS,
-            memory=PARAMS["picard_memory"],
-            cpu=PARAMS["picard_threads"])
-
-    picard_summary, picard_histogram = [ x.replace(".sentinel", "") for x in sentinels ]
-    picard_histogram_pdf = picard_histogram + ".pdf"
-
-    if PARAMS["picard_insertsizemetric_options"]:
-        picard_options = PARAMS["picard_insertsizemetric_options"]
-    else:
-        picard_options = ""
-
-    validation_stringency = PARAMS["picard_validation_stringency"]
-    
-    reference_sequence = os.path.join(PARAMS["txseq_annotations"],
-                                      "api.dir/txseq.genome.fa.gz")
-    
-    if not os.path.exists(reference_sequence):
-        raise ValueError("Reference sequence not found")
-
-    mktemp_template = "ctmp.CollectInsertSizeMetrics.XXXXXXXXXX"
-
-    statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s CollectInsertSizeMetrics
-                   -I %(infile)s
-                   -O $picard_out
-                   --Histogram_FILE %(picard_histogram_pdf)s
-                   --VALIDATION_STRINGENCY %(validation_stringency)s
-                   --REFERENCE_SEQUENCE %(reference_sequence)s
-                   %(picard_options)s;
-                   grep "MEDIAN_INSERT_SIZE" -A 1 $picard_out
-                   > %(picard_summary)s;
-                   sed -e '1,/## HISTOGRAM/d' $picard_out
-                   > %(picard_histogram)s;
-                   rm $picard_out;
-                ''' % dict(PARAMS, **t.var, **locals())
-
-    P.run(statement, **t.resources)
-    
-    for sentinel in sentinels: 
-        IOTools.touch_file(sentinel)
-
-@active_if(PAIRED)
-@merge(insertSizeMetricsAndHistograms,
-       "bam.qc.dir/qc_insert_size_metrics.load")
-def loadInsertSizeMetrics(infiles, outfile):
-    '''
-    Load the insert size metrics to a single table of the project database.
-    '''
-
-    picard_summaries = [x[0].replace(".sentinel", "") for x in infiles]
-
-    P.concatenate_and_load(picard_summaries, outfile,
-                            regex_filename=(".*/.*/(.*)"
-                                            ".insert.size.metrics.summary"),
-                            cat="sample_id",
-                            options='')
-
-
-@active_if(PAIRED)
-@merge(insertSizeMetricsAndHistograms,
-       "bam.qc.dir/qc_insert_size_histogram.load")
-def loadInsertSizeHistograms(infiles, outfile):
-    '''
-    Load the histograms to a single table of the project database.
-    '''
-
-    picard_histograms = [x[1].replace(".sentinel", "") for x in infiles]
-
-    P.concatenate_and_load(
-        picard_histograms, outfile,
-        regex_filename=(".*/.*/(.*)"
-                        ".insert.size.metrics.histogram"),
-        cat="sample_id",
-        options='-i "insert_size" -e')
-
+    T.bulk_load(infiles, outfile,
+                regex_filename=".*/.*/(.*).library.complexity",
+                cat="sample_id",
+                database=PARAMS["sqlite_file"])
 
 
 
@@ -494,11 +583,9 @@ def loadInsertSizeHistograms(infiles, outfile):
 
 def fraction_spliced_jobs():
 
-    for sample_id in S.samples.keys():
-    
-        yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
-                os.path.join("bam.qc.dir/fraction.spliced.dir/",
-                            sample_id + ".fraction.spliced.sentinel")])
+    for bam_file, outputs in per_sample_jobs():
+
+        yield([bam_file, outputs["fraction_spliced"]])
 
 @files(fraction_spliced_jobs)
 def fractionSpliced(infile, sentinel):
@@ -508,22 +595,22 @@ def fractionSpliced(infile, sentinel):
     * only uniquely mapping reads are considered.
     '''
     
-    t = T.setup(infile, sentinel, PARAMS)
-
-    statement = '''echo "fraction_spliced" > %(out_file)s;
-                   samtools view %(infile)s
-                   | grep NH:i:1
-                   | cut -f 6
-                   | awk '{if(index($1,"N")==0){us+=1}
-                           else{s+=1}}
-                          END{print s/(us+s)}'
-                   >> %(out_file)s
+    t = T.setup(infile, sentinel, PARAMS,
+                cpu=PARAMS["htslib_threads"])
+
+    statement = '''python %(txseq_code_dir)s/python/bam_fraction_spliced.py
+                   --bam %(infile)s
+                   --threads %(htslib_threads)s
+                   --outfile %(out_file)s
+                   &> %(log_file)s
                  ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
     IOTools.touch_file(sentinel)
 
 
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
 @merge(fractionSpliced,
        "bam.qc.dir/qc_fraction_spliced.load")
 def loadFractionSpliced(infiles, outfile):
@@ -533,15 +620,17 @@ def loadFractionSpliced(infiles, outfile):
     
     infiles = [x.replace(".sentinel","") for x in infiles]
 
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).fraction.spliced",
-                           cat="sample_id",
-                           options='-i "sample_id"')
+    T.bulk_load(infiles, outfile,
+                regex_filename=".*/.*/(.*).fraction.spliced",
+                cat="sample_id",
+                database=PARAMS["sqlite_file"])
 
 
 # ---------------- Prepare a post-mapping QC summary ------------------------ #
 
 
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
 @files(PARAMS["samples"],
            "samples.load")
 def loadSampleInformation(infile, outfile):
@@ -549,7 +638,7 @@ def loadSampleInformation(infile, outfile):
     Load the sample information table to the project database.
     '''
 
-    P.load(infile, outfile, options='-i "sample_id"')
+    P.load(infile, outfile)
 
 
 @merge([loadSampleInformation,
@@ -568,70 +657,78 @@ def qcSummary(infiles, outfile):
     # Some QC metrics are specific to paired end data
     if PAIRED:
         exclude = []
-        paired_columns = '''READ_PAIRS_EXAMINED as no_pairs,
-                              PERCENT_DUPLICATION as pct_duplication,
-                              PCT_READS_ALIGNED_IN_PAIRS
-                                       as pct_reads_aligned_in_pairs,
-                              MEDIAN_INSERT_SIZE
-                                       as median_insert_size,
-                           '''
         pcat = "PAIR"
-   
+
     else:
         exclude = ["qc_library_complexity", "qc_insert_size_metrics"]
-        paired_columns = ''
         pcat = "UNPAIRED"
 
-   if PARAMS["run_estimateLibraryComplexity"] and PAIRED:
-
-      elc_columns = '''ESTIMATED_LIBRARY_SIZE as library_size,'''
-
-   else:
-      elc_columns = ''
-   
-
-    # ESTIMATED_LIBRARY_SIZE as library_size,
+    if not (PARAMS["run_estimateLibraryComplexity"] and PAIRED):
+        exclude.append("qc_library_complexity")
+
+    # (table, column, summary column name)
+    summary_columns = [
+        ("qc_fraction_spliced", "fraction_spliced", "fraction_spliced"),
+        ("qc_three_prime_bias", "three_prime_bias", "three_prime_bias"),
+        ("qc_library_complexity", "READ_PAIRS_EXAMINED", "no_pairs"),
+        ("qc_library_complexity", "PERCENT_DUPLICATION", "pct_duplication"),
+        ("qc_alignment_summary_metrics", "PCT_READS_ALIGNED_IN_PAIRS",
+         "pct_reads_aligned_in_pairs"),
+        ("qc_insert_size_metrics", "MEDIAN_INSERT_SIZE", "median_insert_size"),
+        ("qc_library_complexity", "ESTIMATED_LIBRARY_SIZE", "library_size"),
+        ("qc_rnaseq_metrics", "PCT_MRNA_BASES", "pct_mrna"),
+        ("qc_rnaseq_metrics", "PCT_CODING_BASES", "pct_coding"),
+        ("qc_alignment_summary_metrics", "PCT_PF_READS_ALIGNED",
+         "pct_reads_aligned"),
+        ("qc_alignment_summary_metrics", "TOTAL_READS", "total_reads"),
+        ("qc_alignment_summary_metrics", "PCT_ADAPTER", "pct_adapter"),
+        ("qc_alignment_summary_metrics", "pct_pf_reads_aligned_hq",
+         "pct_pf_reads_aligned_hq")]
+
+    if not PAIRED:
+        summary_columns = [x for x in summary_columns
+                           if x[2] != "pct_reads_aligned_in_pairs"]
 
     tables = [P.to_table(x) for x in infiles
               if P.to_table(x) not in exclude]
 
-    t1 = tables[0]
-
-    stat_start = '''select distinct samples.*,
-                                    fraction_spliced,
-                                    three_prime_bias
-                                       as three_prime_bias,
-                                    %(paired_columns)s
-                                    %(elc_columns)s
-                                    PCT_MRNA_BASES
-                                       as pct_mrna,
-                                    PCT_CODING_BASES
-                                       as pct_coding,
-                                    PCT_PF_READS_ALIGNED
-                                       as pct_reads_aligned,
-                                    TOTAL_READS
-                                       as total_reads,
-                                    PCT_ADAPTER
-                                       as pct_adapter,
-                                    PF_HQ_ALIGNED_READS*1.0/PF_READS
-                                       as pct_pf_reads_aligned_hq
-                   from %(t1)s
-                ''' % locals()
-
-    join_stat = ""
+    con = T.connect(PARAMS["sqlite_file"])
+
+    df = pd.read_sql("select * from %s" % tables[0], con)
+    df = df.set_index("sample_id")
+
+    dfs = []
     for table in tables[1:]:
-        join_stat += "left join " + table + "\n"
-        join_stat += "on " + t1 + ".sample_id=" + table + ".sample_id\n"
 
-    where_stat = '''where qc_alignment_summary_metrics.CATEGORY="%(pcat)s"
-                 ''' % locals()
+        columns = dict((c, a) for t, c, a in summary_columns if t == table)
+
+        if len(columns) == 0:
+            continue
+
+        tab = pd.read_sql("select * from %s" % table, con)
+
+        if table == "qc_alignment_summary_metrics":
+            tab = tab[tab["CATEGORY"] == pcat].copy()
+            tab["pct_pf_reads_aligned_hq"] = (tab["PF_HQ_ALIGNED_READS"] * 1.0
+                                              / tab["PF_READS"])
+
+        tab = tab[["sample_id"] + list(columns.keys())].rename(columns=columns)
+        dfs.append(tab.set_index("sample_id"))
 
-    statement = "\n".join([stat_start, join_stat, where_stat])
+    con.close()
 
-    df = DB.fetch_DataFrame(statement, PARAMS["sqlite_file"])
-    df.to_csv(outfile, sep="\t", index=False)
+    sample_columns = list(df.columns)
 
+    df = df.join(dfs, how="left")
 
+    df = df[sample_columns + [a for t, c, a in summary_columns
+                              if a in df.columns]]
+
+    df.reset_index().to_csv(outfile, sep="\t", index=False)
+
+
+@jobs_limit(PARAMS["sqlite_load_jobs"], "sqlite_load")
+@follows(configureDb)
 @transform(qcSummary,
            suffix(".txt"),
            ".load")
@@ -643,7 +740,49 @@ def loadQCSummary(infile, outfile):
     P.load(infile, outfile)
 
 
-@follows(loadQCSummary, loadInsertSizeHistograms)
+@merge([loadSampleInformation,
+        loadCollectRnaSeqMetrics,
+        loadThreePrimeBias,
+        loadEstimateLibraryComplexity,
+        loadFractionSpliced,
+        loadAlignmentSummaryMetrics,
+        loadInsertSizeMetrics,
+        loadInsertSizeHistograms,
+        loadQCSummary],
+       "bam.qc.dir/indexes.sentinel")
+def buildIndexes(infiles, sentinel):
+    '''
+    Index the loaded tables on sample_id.
+
+    The indexes are built once all of the tables have been loaded
+    rather than being maintained during the inserts.
+    '''
+
+    index_columns = {"qc_insert_size_histogram": ["sample_id", "insert_size"]}
+
+    con = T.connect(PARAMS["sqlite_file"], isolation_level=None)
+
+    loaded = set(x[0] for x in con.execute(
+        "select name from sqlite_master where type='table'"))
+
+    con.execute("BEGIN IMMEDIATE")
+
+    for table in [P.to_table(x) for x in infiles]:
+
+        if table not in loaded:
+            continue
+
+        for column in index_columns.get(table, ["sample_id"]):
+            con.execute("CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s(%s)" % (
+                table, column, table, column))
+
+    con.execute("COMMIT")
+    con.close()
+
+    IOTools.touch_file(sentinel)
+
+
+@follows(buildIndexes)
 def qc():
     '''
     Target for executing quality control.
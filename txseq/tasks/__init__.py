@@ -9,6 +9,7 @@ Core components:
 * `parameters`_
 * `setup`_
 * `api`_
+* `db`_
 
 Pipeline specific components:
 
@@ -26,4 +27,5 @@ Pipeline specific components:
 
 from txseq.tasks.setup import *
 from txseq.tasks.parameters import *
-from txseq.tasks.api import *
\ No newline at end of file
+from txseq.tasks.api import *
+from txseq.tasks.db import *
@@ -0,0 +1,44 @@
+"""
+_bias.py
+========
+
+A single pass reduction of the Picard normalised coverage histogram
+used to compute the three prime bias.
+
+The kernel is compiled with numba when it is available, otherwise it
+runs as plain python (the histograms only have ~100 bins).
+
+"""
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+
+@njit(cache=True)
+def compute_bias(x, cov):
+    '''
+    Return the mean coverage between 70% and 90% of transcript length
+    divided by the mean coverage between 20% and 90%.
+
+    Args:
+        x: array of normalised positions (0-100)
+        cov: array of normalised coverage values
+    '''
+
+    s3 = n3 = sb = nb = 0.0
+
+    for i in range(x.size):
+        xi = x[i]
+
+        if xi > 70 and xi < 90:
+            s3 += cov[i]
+            n3 += 1
+
+        if xi > 20 and xi < 90:
+            sb += cov[i]
+            nb += 1
+
+    return (s3 / n3) / (sb / nb)
@@ -0,0 +1,152 @@
+"""
+db.py
+=====
+
+Helper functions for loading pipeline results into the project
+sqlite database.
+
+"""
+
+import re
+import sqlite3
+import importlib.util
+import pandas as pd
+
+__all__ = ["configure_database", "connect", "bulk_load"]
+
+# The multithreaded pyarrow csv parser is used when it is installed
+if importlib.util.find_spec("pyarrow") is not None:
+    CSV_ENGINE = "pyarrow"
+else:
+    CSV_ENGINE = "c"
+
+
+# per-connection settings applied by connect()
+PRAGMAS = ["PRAGMA synchronous=NORMAL",
+           "PRAGMA cache_size=-262144",
+           "PRAGMA temp_store=MEMORY",
+           "PRAGMA mmap_size=268435456"]
+
+
+def configure_database(database):
+    '''
+    Switch the sqlite database to write-ahead logging so that readers
+    are not blocked by the load tasks. The journal mode is persistent.
+    '''
+
+    con = sqlite3.connect(database, timeout=600)
+    mode = con.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    con.close()
+
+    return mode
+
+
+def connect(database, **kwargs):
+    '''
+    Return a connection to the sqlite database with the PRAGMAS set.
+    '''
+
+    con = sqlite3.connect(database, timeout=600, **kwargs)
+
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+
+    return con
+
+
+def _sql_type(dtype):
+    '''
+    Return the sqlite column type for a pandas dtype.
+    '''
+
+    if pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    elif pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    else:
+        return "TEXT"
+
+
+def bulk_load(infiles, outfile,
+              regex_filename,
+              cat="sample_id",
+              database="csvdb",
+              engine=None):
+    '''
+    Concatenate a set of tab-delimited tables and load them into a
+    single table of the sqlite database.
+
+    This is a replacement for P.concatenate_and_load: all of the rows
+    are inserted with a single executemany in one transaction rather
+    than row-wise by csv2db.
+
+    Args:
+        infiles: A list of tab-delimited files with a header line.
+        outfile: The ".load" file, the table name is derived from it.
+        regex_filename: A regular expression with a single group that
+            captures the value of the "cat" column from each file name.
+        cat: The name of the column that records the source file.
+        database: The path to the sqlite database file.
+        engine: The pandas csv parser, by default "pyarrow" if it is
+            installed, otherwise "c".
+    '''
+
+    # imported here so that importing txseq.tasks does not require cgatcore
+    from cgatcore import pipeline as P
+
+    table = P.to_table(outfile)
+
+    if engine is None:
+        engine = CSV_ENGINE
+
+    # the pyarrow parser does not support comment lines
+    if engine == "pyarrow":
+        read_options = {}
+    else:
+        read_options = {"comment": "#"}
+
+    tables = []
+    for infile in infiles:
+
+        track = re.search(regex_filename, infile).groups()[0]
+
+        df = pd.read_csv(infile, sep="\t", na_values=["?"],
+                         engine=engine, **read_options)
+        df.insert(0, cat, track)
+        tables.append(df)
+
+    if len(tables) == 0:
+        raise ValueError("No tables to load into %s" % table)
+
+    df = pd.concat(tables, ignore_index=True)
+
+    # sanitise the column names in the same way as csv2db
+    df.columns = [re.sub("[^0-9a-zA-Z_]", "_", x) for x in df.columns]
+
+    columns = ", ".join(["%s %s" % (x, _sql_type(df[x].dtype))
+                         for x in df.columns])
+    placeholders = ", ".join(["?"] * len(df.columns))
+
+    rows = df.astype(object).where(df.notna(), None)
+
+    con = connect(database, isolation_level=None)
+
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("DROP TABLE IF EXISTS %s" % table)
+        con.execute("CREATE TABLE %s (%s)" % (table, columns))
+        con.executemany("INSERT INTO %s VALUES (%s)" % (table, placeholders),
+                        rows.itertuples(index=False, name=None))
+        con.execute("COMMIT")
+
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+
+    finally:
+        con.close()
+
+    with open(outfile, "w") as out_file:
+        out_file.write("loaded %i rows from %i files into %s\n" % (
+            len(df), len(tables), table))
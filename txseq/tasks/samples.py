@@ -20,12 +20,14 @@ Class and method documentation
 
 import yaml
 import os
+import pickle
 import shutil
 import re
 import copy
 import re
 import pandas as pd
 from pprint import pprint
+from txseq.version import __version__
 
 # ------------------------------ utility functions -------------------------------- #
 
@@ -275,3 +277,54 @@ class samples():
 
         
 
+
+# Increment when the layout of the cached samples objects changes
+SAMPLES_CACHE_SCHEMA = 1
+
+
+def load_samples(sample_tsv, library_tsv=None, cache_dir="."):
+    '''
+    Return a samples object for the given tables, using a pickled copy
+    when the tables have not changed since it was written.
+
+    The cache is written to cache_dir (by default the pipeline working
+    directory). It is keyed on the path, modification time and size of
+    the tables and on the txseq version and this module so that it is
+    not reused after an upgrade. Note that the fastq paths are only
+    checked for existence when the tables are parsed.
+    '''
+
+    tables = [x for x in (sample_tsv, library_tsv) if x is not None]
+
+    module_stat = os.stat(__file__)
+
+    key = [SAMPLES_CACHE_SCHEMA, __version__,
+           (module_stat.st_mtime_ns, module_stat.st_size)]
+
+    for table in tables:
+        stat = os.stat(table)
+        key.append((os.path.abspath(table), stat.st_mtime_ns, stat.st_size))
+
+    cache_file = os.path.join(cache_dir,
+                              os.path.basename(tables[-1]) + ".cache.pkl")
+
+    try:
+        with open(cache_file, "rb") as cache:
+            cached_key, cached_samples = pickle.load(cache)
+        if cached_key == key:
+            return cached_samples
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError):
+        pass
+
+    S = samples(sample_tsv=sample_tsv, library_tsv=library_tsv)
+
+    try:
+        tmp_file = cache_file + "." + str(os.getpid())
+        with open(tmp_file, "wb") as cache:
+            pickle.dump((key, S), cache)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+    return S